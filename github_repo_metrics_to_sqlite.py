@@ -7,41 +7,229 @@ Changes from original:
 - config.json now contains a list of {owner, repo} objects under "repositories".
 - SQLite tables now include 'owner' and 'repo' columns as part of the primary key.
 - Loops over all repositories and stores metrics for each.
+- API calls for all repositories are issued concurrently from a thread pool;
+  rate-limited (403/429) and 5xx responses are retried with backoff.
+- Each worker thread keeps one keep-alive HTTPS connection to the API
+  (tunnelled through $https_proxy when set).
+- Responses are parsed with orjson when it is installed.
+- All rows of a run are written in a single explicit BEGIN IMMEDIATE
+  transaction (WAL mode).
+- Response ETags are cached in SQLite together with the already-extracted
+  rows, so unchanged endpoints answer 304 and skip JSON payload processing.
+- Repo counters are fetched at most once per UTC day per repository.
+- The module is fully type-annotated so it can optionally be compiled with
+  `mypyc github_repo_metrics_to_sqlite.py`; importing the module then picks up
+  the compiled extension, otherwise the pure-Python source is used.
 """
 
 import os
+import base64
 import sys
 import json
 import sqlite3
+import math
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Any, Callable, cast
 from datetime import datetime, timezone
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError, URLError
+from http.client import HTTPSConnection, HTTPException, HTTPMessage, HTTPResponse
+from urllib.parse import unquote, urlsplit
+from urllib.request import getproxies, proxy_bypass
 
-API_ROOT = "https://api.github.com"
+try:
+    import orjson as _json
+except ImportError:  # orjson is optional; stdlib json also accepts bytes
+    import json as _json  # type: ignore[no-redef]
+
+# (date, views, uniques) and (date, stars, forks, watchers) as fetched;
+# owner/repo are prepended before they are written.
+TrafficRow = tuple[str, int, int]
+CountsRow = tuple[str, int, int, int]
+EtagCache = dict[str, tuple[str, bytes]]
+
+API_HOST = "api.github.com"
 DB_PATH = Path("data/github_metrics.sqlite3")
 CONFIG_PATH = Path(__file__).parent / "config.json"
+MAX_WORKERS = 16
+MAX_RETRIES = 5
+# The primary rate limit resets hourly; never wait longer than that
+MAX_RETRY_DELAY = 3600.0
+# sqlite3 caches prepared statements keyed on the SQL text
+SQLITE_CACHED_STATEMENTS = 256
+UPSERT_TRAFFIC_SQL = """
+    INSERT INTO traffic_views_daily(owner, repo, date, views, uniques)
+    VALUES(?, ?, ?, ?, ?)
+    ON CONFLICT(owner, repo, date) DO UPDATE SET
+        views=excluded.views,
+        uniques=excluded.uniques
+"""
+UPSERT_COUNTS_SQL = """
+    INSERT INTO repo_counts_daily(owner, repo, date, stars, forks, watchers)
+    VALUES(?, ?, ?, ?, ?, ?)
+    ON CONFLICT(owner, repo, date) DO UPDATE SET
+        stars=excluded.stars,
+        forks=excluded.forks,
+        watchers=excluded.watchers
+"""
+UPSERT_ETAG_SQL = """
+    INSERT INTO etag_cache(path, etag, parsed)
+    VALUES(?, ?, ?)
+    ON CONFLICT(path) DO UPDATE SET
+        etag=excluded.etag,
+        parsed=excluded.parsed
+"""
+BASE_HEADERS = {
+    "Accept": "application/vnd.github+json",
+    "X-GitHub-Api-Version": "2022-11-28",
+    # http.client sends no User-Agent and GitHub rejects such requests with 403
+    "User-Agent": "github-stats",
+}
 
-def gh_get(path: str, token: str, accept: str = "application/vnd.github+json"):
-    url = f"{API_ROOT}{path}"
-    req = Request(url)
-    req.add_header("Accept", accept)
-    req.add_header("X-GitHub-Api-Version", "2022-11-28")
-    if token:
-        req.add_header("Authorization", f"Bearer {token}")
+_local = threading.local()
+
+def get_connection() -> HTTPSConnection:
+    """Return this thread's keep-alive connection to the GitHub API.
+
+    Like urlopen, an HTTPS proxy from the environment (https_proxy/no_proxy)
+    is honoured by tunnelling through it with CONNECT.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        proxy = getproxies().get("https")
+        if proxy and not proxy_bypass(API_HOST):
+            p = urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+            tunnel_headers = {}
+            if p.username:
+                creds = f"{unquote(p.username)}:{unquote(p.password or '')}"
+                tunnel_headers["Proxy-Authorization"] = "Basic " + base64.b64encode(creds.encode()).decode("ascii")
+            conn = HTTPSConnection(p.hostname or "", p.port, timeout=30)
+            conn.set_tunnel(API_HOST, headers=tunnel_headers)
+        else:
+            conn = HTTPSConnection(API_HOST, timeout=30)
+        _local.conn = conn
+    return conn
+
+def _reset_connection() -> None:
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+def _send(path: str, headers: dict[str, str]) -> tuple[HTTPResponse, bytes]:
+    conn = get_connection()
+    reused = conn.sock is not None
     try:
-        with urlopen(req, timeout=30) as resp:
-            return json.loads(resp.read().decode("utf-8"))
-    except HTTPError as e:
-        body = e.read().decode("utf-8", errors="ignore")
-        raise SystemExit(f"GitHub API error {e.code} for {path}: {body}")
-    except URLError as e:
-        raise SystemExit(f"Network error calling {path}: {e}")
-
-def ensure_db():
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        return resp, resp.read()
+    except (HTTPException, OSError):
+        _reset_connection()
+        if not reused:
+            raise
+    # The server may have dropped the idle keep-alive socket; retry once fresh
+    conn = get_connection()
+    conn.request("GET", path, headers=headers)
+    resp = conn.getresponse()
+    return resp, resp.read()
+
+def _is_retryable(status: int, headers: HTTPMessage) -> bool:
+    if status == 429 or status >= 500:
+        return True
+    # 403 is only transient when it comes from the (primary or secondary) rate limit
+    return status == 403 and (
+        headers.get("X-RateLimit-Remaining") == "0" or "Retry-After" in headers
+    )
+
+def _header_seconds(headers: HTTPMessage, name: str) -> float | None:
+    # None for a missing, non-numeric (e.g. HTTP-date Retry-After) or
+    # non-finite value, so the caller falls back to the regular backoff
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    return seconds if math.isfinite(seconds) else None
+
+def _retry_delay(headers: HTTPMessage, attempt: int) -> float:
+    delay = float(2 ** attempt)
+    retry_after = _header_seconds(headers, "Retry-After")
+    reset = _header_seconds(headers, "X-RateLimit-Reset")
+    if retry_after is not None:
+        delay = retry_after
+    elif headers.get("X-RateLimit-Remaining") == "0" and reset is not None:
+        delay = reset - time.time() + 1
+    return min(max(0.0, delay), MAX_RETRY_DELAY)
+
+def _dumps(obj: Any) -> bytes:
+    data = _json.dumps(obj)
+    return data if isinstance(data, bytes) else data.encode("utf-8")
+
+def gh_get(path: str, token: str, accept: str = "application/vnd.github+json",
+           etags: EtagCache | None = None,
+           extract: Callable[[Any], Any] | None = None) -> Any:
+    """GET `path` and return the decoded JSON, passed through `extract` if given.
+
+    If `etags` (a dict of path -> (etag, serialized result)) is given, a
+    conditional request is made; on 304 the cached result is returned without
+    touching the GitHub payload, on 200 the entry is refreshed in place.
+    Tuples in a cached result come back as lists.
+    """
+    key = path
+    headers = {**BASE_HEADERS, "Accept": accept}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    cached = etags.get(key) if etags is not None else None
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            resp, body = _send(path, headers)
+        except (HTTPException, OSError) as e:
+            _reset_connection()
+            raise SystemExit(f"Network error calling {path}: {e}")
+        if resp.status == 304 and cached:
+            return _json.loads(cached[1])
+        if resp.status < 300:
+            result = _json.loads(body)
+            if extract is not None:
+                result = extract(result)
+            etag = resp.getheader("ETag")
+            if etags is not None and etag:
+                etags[key] = (etag, _dumps(result))
+            return result
+        location = resp.getheader("Location")
+        if resp.status in (301, 302, 307, 308) and location:
+            # Renamed/transferred repos redirect to /repositories/<id>
+            loc = urlsplit(location)
+            path = f"{loc.path}?{loc.query}" if loc.query else loc.path
+            continue
+        if attempt < MAX_RETRIES and _is_retryable(resp.status, resp.headers):
+            # Don't hold an idle socket across the wait; the server would drop it
+            _reset_connection()
+            time.sleep(_retry_delay(resp.headers, attempt))
+            continue
+        raise SystemExit(f"GitHub API error {resp.status} for {path}: {body.decode('utf-8', errors='ignore')}")
+    raise SystemExit(f"Giving up on {path} after {MAX_RETRIES + 1} attempts")
+
+def ensure_db() -> sqlite3.Connection:
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+    # Autocommit mode: transactions are opened explicitly in main() rather
+    # than by the sqlite3 module's implicit BEGIN DEFERRED
+    conn = sqlite3.connect(DB_PATH, cached_statements=SQLITE_CACHED_STATEMENTS,
+                           isolation_level=None)
     cur = conn.cursor()
+    # WAL + NORMAL: a single fsync of the WAL per commit instead of per page write
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    # Keep rollup sort/group temp structures in RAM, allow a 64 MiB page
+    # cache and read pages through a 256 MiB mmap instead of pread()
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-65536")
+    cur.execute("PRAGMA mmap_size=268435456")
     cur.execute("""
         CREATE TABLE IF NOT EXISTS traffic_views_daily(
             owner TEXT NOT NULL,
@@ -52,6 +240,11 @@ def ensure_db():
             PRIMARY KEY (owner, repo, date)
         )
     """)
+    # Covering index so the monthly rollup is answered from the index alone
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS ix_traffic_rollup
+        ON traffic_views_daily(owner, repo, date, views, uniques)
+    """)
     cur.execute("""
         CREATE TABLE IF NOT EXISTS repo_counts_daily(
             owner TEXT NOT NULL,
@@ -63,52 +256,82 @@ def ensure_db():
             PRIMARY KEY (owner, repo, date)
         )
     """)
-    conn.commit()
+    cur.execute("PRAGMA table_info(etag_cache)")
+    if "body" in {row[1] for row in cur.fetchall()}:
+        # Older layout cached raw response bodies; it is only a cache, so rebuild it
+        cur.execute("DROP TABLE etag_cache")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS etag_cache(
+            path TEXT PRIMARY KEY,
+            etag TEXT NOT NULL,
+            parsed BLOB NOT NULL
+        )
+    """)
     return conn
 
-def upsert_traffic_views(conn, owner, repo, rows):
-    cur = conn.cursor()
-    cur.executemany("""
-        INSERT INTO traffic_views_daily(owner, repo, date, views, uniques)
-        VALUES(?, ?, ?, ?, ?)
-        ON CONFLICT(owner, repo, date) DO UPDATE SET
-            views=excluded.views,
-            uniques=excluded.uniques
-    """, [(owner, repo, r["date"], r["views"], r["uniques"]) for r in rows])
-    conn.commit()
-
-def upsert_repo_counts(conn, owner, repo, snapshot):
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO repo_counts_daily(owner, repo, date, stars, forks, watchers)
-        VALUES(?, ?, ?, ?, ?, ?)
-        ON CONFLICT(owner, repo, date) DO UPDATE SET
-            stars=excluded.stars,
-            forks=excluded.forks,
-            watchers=excluded.watchers
-    """, (owner, repo, snapshot["date"], snapshot["stars"], snapshot["forks"], snapshot["watchers"]))
-    conn.commit()
-
-def fetch_traffic_views(owner, repo, token):
-    payload = gh_get(f"/repos/{owner}/{repo}/traffic/views", token)
-    rows = []
-    for v in payload.get("views", []):
-        d = v["timestamp"][:10]
-        rows.append({"date": d, "views": int(v.get("count", 0)), "uniques": int(v.get("uniques", 0))})
-    return rows
-
-def fetch_repo_counts(owner, repo, token):
-    repo_json = gh_get(f"/repos/{owner}/{repo}", token)
-    now = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    return {
-        "date": now,
-        "stars": int(repo_json.get("stargazers_count", 0)),
-        "forks": int(repo_json.get("forks_count", 0)),
-        "watchers": int(repo_json.get("subscribers_count", 0)),
-    }
-
-def print_rollups(conn):
-    cur = conn.cursor()
+def load_etag_cache(cur: sqlite3.Cursor) -> EtagCache:
+    cur.execute("SELECT path, etag, parsed FROM etag_cache")
+    return {path: (etag, parsed) for path, etag, parsed in cur.fetchall()}
+
+def upsert_etag_cache(cur: sqlite3.Cursor, entries: list[tuple[str, str, bytes]]) -> None:
+    cur.executemany(UPSERT_ETAG_SQL, entries)
+
+def load_counted_repos(cur: sqlite3.Cursor, date: str) -> set[tuple[str, str]]:
+    cur.execute("SELECT owner, repo FROM repo_counts_daily WHERE date = ?", (date,))
+    return {(owner, repo) for owner, repo in cur.fetchall()}
+
+def upsert_traffic_views(cur: sqlite3.Cursor, rows: list[tuple[str, str, str, int, int]]) -> None:
+    cur.executemany(UPSERT_TRAFFIC_SQL, rows)
+
+def upsert_repo_counts(cur: sqlite3.Cursor, snapshots: list[tuple[str, str, str, int, int, int]]) -> None:
+    cur.executemany(UPSERT_COUNTS_SQL, snapshots)
+
+def _extract_traffic(payload: Any) -> list[TrafficRow]:
+    # (date, views, uniques) tuples, ready to be bound by executemany. The
+    # 14-day window is the same for every repo, so intern the date strings
+    # to share one object per day across all rows.
+    return [
+        (sys.intern(v["timestamp"][:10]), int(v.get("count", 0)), int(v.get("uniques", 0)))
+        for v in payload.get("views", [])
+    ]
+
+def _extract_counts(repo_json: Any) -> tuple[int, int, int]:
+    return (
+        int(repo_json.get("stargazers_count", 0)),
+        int(repo_json.get("forks_count", 0)),
+        int(repo_json.get("subscribers_count", 0)),
+    )
+
+def fetch_traffic_views(owner: str, repo: str, token: str,
+                        etags: EtagCache | None = None) -> list[TrafficRow]:
+    rows = gh_get(f"/repos/{owner}/{repo}/traffic/views", token, etags=etags,
+                  extract=_extract_traffic)
+    if rows and not isinstance(rows[0], tuple):
+        # Served from the ETag cache (304), which decodes rows as lists
+        return [(sys.intern(d), views, uniques) for d, views, uniques in rows]
+    return cast("list[TrafficRow]", rows)
+
+def fetch_repo_counts(owner: str, repo: str, token: str, today: str,
+                      etags: EtagCache | None = None) -> CountsRow:
+    stars, forks, watchers = gh_get(f"/repos/{owner}/{repo}", token, etags=etags,
+                                    extract=_extract_counts)
+    # (date, stars, forks, watchers), bound alongside owner/repo by executemany
+    return (today, stars, forks, watchers)
+
+def fetch_repo(owner: str, repo: str, token: str, today: str,
+               etags: EtagCache | None = None,
+               want_counts: bool = True) -> tuple[list[TrafficRow], CountsRow | None]:
+    print(f"Processing {owner}/{repo}...")
+
+    # Traffic only covers the last 14 days and must always be fetched; the
+    # counts snapshot is skipped when today's row is already stored.
+    traffic_rows = fetch_traffic_views(owner, repo, token, etags)
+    snapshot = fetch_repo_counts(owner, repo, token, today, etags) if want_counts else None
+    return traffic_rows, snapshot
+
+def print_rollups(cur: sqlite3.Cursor) -> None:
+    # Collect the whole report and emit it with a single write
+    out: list[str] = []
 
     # Monthly roll-up per repo
     cur.execute("""
@@ -119,67 +342,124 @@ def print_rollups(conn):
         GROUP BY owner, repo, ym
         ORDER BY owner, repo, ym
     """)
-    rows = cur.fetchall()
-    print("\n=== Historical monthly (per repo) ===")
-    for owner, repo, ym, v, u in rows:
-        print(f"{owner}/{repo} - {ym}: views={v:,} | daily-uniques-sum={u:,}")
+    out.append("\n=== Historical monthly (per repo) ===")
+    out.extend(
+        f"{owner}/{repo} - {ym}: views={v:,} | daily-uniques-sum={u:,}"
+        for owner, repo, ym, v, u in cur
+    )
 
-    # Latest counts snapshot
+    # Latest counts snapshot. With a single MAX() aggregate, SQLite takes the
+    # bare columns from the row holding the max date, so this is one ordered
+    # pass over the primary-key index.
     cur.execute("""
-        SELECT owner, repo, date, stars, forks, watchers
+        SELECT owner, repo, MAX(date) AS date, stars, forks, watchers
         FROM repo_counts_daily
-        WHERE (owner, repo, date) IN (
-            SELECT owner, repo, MAX(date)
-            FROM repo_counts_daily
-            GROUP BY owner, repo
-        )
+        GROUP BY owner, repo
         ORDER BY owner, repo
     """)
-    latest = cur.fetchall()
-    print("\n=== Latest counts snapshots ===")
-    for owner, repo, d, stars, forks, watchers in latest:
-        print(f"{owner}/{repo} [{d}]: ⭐ {stars:,}  | 🍴 {forks:,}  | 👀 {watchers:,}")
+    out.append("\n=== Latest counts snapshots ===")
+    out.extend(
+        f"{owner}/{repo} [{d}]: ⭐ {stars:,}  | 🍴 {forks:,}  | 👀 {watchers:,}"
+        for owner, repo, d, stars, forks, watchers in cur
+    )
 
-    print(f"\nSQLite DB: {DB_PATH.resolve()}")
+    out.append(f"\nSQLite DB: {DB_PATH.resolve()}")
+    sys.stdout.write("\n".join(out) + "\n")
 
-def load_config():
+def load_config() -> dict[str, Any]:
     if not CONFIG_PATH.exists():
         raise FileNotFoundError(f"Config file not found: {CONFIG_PATH}")
     with open(CONFIG_PATH, "r") as f:
-        return json.load(f)
+        config: dict[str, Any] = json.load(f)
+    return config
 
-def main():
+def main() -> None:
     config = load_config()
     token = config.get("github_token")
     repos = config.get("repositories", [])
+    max_workers = config.get("max_workers", MAX_WORKERS)
 
     if not token:
         raise SystemExit("Error: github_token missing in config.json")
     if not repos:
         raise SystemExit("Error: repositories list is empty in config.json")
+    if isinstance(max_workers, bool) or not isinstance(max_workers, int) or max_workers < 1:
+        raise SystemExit("Error: max_workers must be a positive integer in config.json")
 
     conn = ensure_db()
+    cur = conn.cursor()
 
+    targets = []
     for repo_cfg in repos:
         owner = repo_cfg.get("owner")
         repo = repo_cfg.get("repo")
         if not owner or not repo:
             print(f"Skipping invalid repo entry: {repo_cfg}")
             continue
+        targets.append((owner, repo))
+
+    # Fetch traffic + counts for all repos concurrently; SQLite writes stay
+    # on this thread since the connection must not be shared. Workers only
+    # touch their own paths in `etags`.
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    cached_etags = load_etag_cache(cur)
+    etags = dict(cached_etags)
+    counted = load_counted_repos(cur, today)
+    results: dict[tuple[str, str], tuple[list[TrafficRow], CountsRow | None]] = {}
+    failures: list[str] = []
+    # Each worker holds its own keep-alive connection, so don't start more
+    # threads (and TLS handshakes) than there are repositories.
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(targets)))) as pool:
+        futures = {
+            pool.submit(fetch_repo, owner, repo, token, today, etags,
+                        (owner, repo) not in counted): (owner, repo)
+            for owner, repo in targets
+        }
+        # One failing repo (deleted, no traffic access, ...) must not discard
+        # the data fetched for all the others
+        for future in as_completed(futures):
+            owner, repo = futures[future]
+            try:
+                results[(owner, repo)] = future.result()
+            except (SystemExit, Exception) as e:
+                print(f"Failed {owner}/{repo}: {e}", file=sys.stderr)
+                failures.append(f"{owner}/{repo}: {e}")
+
+    # Drop cache entries of failed repos so their rows are refetched next run
+    failed = {f"/repos/{owner}/{repo}" for owner, repo in targets if (owner, repo) not in results}
+    new_etags = [
+        (path, etag, parsed) for path, (etag, parsed) in etags.items()
+        if cached_etags.get(path, (None,))[0] != etag
+        and path.removesuffix("/traffic/views") not in failed
+    ]
 
-        print(f"Processing {owner}/{repo}...")
+    all_traffic: list[tuple[str, str, str, int, int]] = []
+    all_counts: list[tuple[str, str, str, int, int, int]] = []
+    for owner, repo in targets:
+        if (owner, repo) not in results:
+            continue
+        traffic_rows, snapshot = results[(owner, repo)]
 
         # 1) Traffic
-        traffic_rows = fetch_traffic_views(owner, repo, token)
-        if traffic_rows:
-            upsert_traffic_views(conn, owner, repo, traffic_rows)
+        all_traffic.extend((owner, repo, *r) for r in traffic_rows)
 
         # 2) Repo counts snapshot
-        snapshot = fetch_repo_counts(owner, repo, token)
-        upsert_repo_counts(conn, owner, repo, snapshot)
+        if snapshot is not None:
+            all_counts.append((owner, repo, *snapshot))
+
+    # Write everything in one transaction (one commit / fsync per run). Take
+    # the write lock up front so the transaction never has to upgrade.
+    with conn:
+        cur.execute("BEGIN IMMEDIATE")
+        upsert_traffic_views(cur, all_traffic)
+        upsert_repo_counts(cur, all_counts)
+        upsert_etag_cache(cur, new_etags)
 
     # 3) Print rollups
-    print_rollups(conn)
+    print_rollups(cur)
+
+    if failures:
+        raise SystemExit(f"Error: failed to fetch {len(failures)} of {len(targets)} repositories:\n" + "\n".join(failures))
 
 if __name__ == "__main__":
     main()